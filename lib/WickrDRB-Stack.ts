@@ -286,7 +286,7 @@ export class WickrDRBStack extends Stack {
             document: new PolicyDocument({
               statements: [
                 new PolicyStatement({
-                  actions: ['logs:DescribeLogStreams', 'logs:GetLogEvents', 'logs:DeleteLogStream', 'logs:CreateLogStream', 'logs:PutLogEvents'],
+                  actions: ['logs:FilterLogEvents', 'logs:GetLogEvents', 'logs:DeleteLogStream', 'logs:CreateLogStream', 'logs:PutLogEvents'],
                   resources: [
                     logGroup.logGroupArn,
                     `${logGroup.logGroupArn}:*`,
@@ -316,6 +316,7 @@ export class WickrDRBStack extends Stack {
       reservedConcurrentExecutions: 1,
       environment: {
         LOG_GROUP_NAME: logGroup.logGroupName,
+        LOG_RETENTION_DAYS: getCloudWatchLogRetention(dataExpirationInYears).toString(),
         SECRET_ARN: wickrSecret.secretArn,
         BUCKET_NAME: dataBucket.bucketName,
         KMS_KEY_ID: infraKey.keyId
@@ -4,19 +4,107 @@ import json
 import re
 import os
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 PASSWORD_MARKER = '**** GENERATED PASSWORD'
-PASSWORD_REGEX = r'^[A-Za-z0-9]{20,}$'
 SIGNING_KEY_REGEX = r'^[0-9a-f]{4}\s+[0-9a-f]{4}'
 REDACTED_TEXT = '[REDACTED]'
+MAX_WORKERS = 10
+# The bot logs its password at first start, just before this function runs on deploy
+SEARCH_WINDOW_MS = 7 * 24 * 60 * 60 * 1000
+# Signing key output spans at least this many lines, once collected later streams are not read for it
+EXPECTED_KEY_LINES = 8
+# PutLogEvents limits, each event counts its UTF-8 message size plus 26 bytes
+MAX_BATCH_BYTES = 1_000_000
+MAX_BATCH_EVENTS = 10_000
+MAX_BATCH_SPAN_MS = 24 * 60 * 60 * 1000
+EVENT_OVERHEAD_BYTES = 26
+# PutLogEvents drops events older than 14 days or the retention period, or over 2 hours ahead,
+# the margin covers time passing between the check and the upload
+MAX_EVENT_AGE_MS = 14 * 24 * 60 * 60 * 1000
+MAX_EVENT_LEAD_MS = 2 * 60 * 60 * 1000
+REWRITE_MARGIN_MS = 10 * 60 * 1000
+# Matches the password marker, public key lines and password-like lines server side
+STREAM_FILTER_PATTERN = r'%GENERATED PASSWORD|^[0-9a-f]{4}\s+[0-9a-f]{4}|^\s*[A-Za-z0-9]{20,}\s*$%'
+
+_SIGNING_KEY_RE = re.compile(SIGNING_KEY_REGEX)
+_HEX_DIGITS = frozenset('0123456789abcdef')
+
+# AWS clients are created once per execution environment and reused on warm invocations
+_USE_FIPS = os.environ['AWS_REGION'].startswith(('us', 'ca')) or None
+_BOTO_CONFIG = Config(
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    use_fips_endpoint=_USE_FIPS,
+    max_pool_connections=20
+)
+_LOGS_CLIENT = boto3.client('logs', config=_BOTO_CONFIG)
+_SECRETS_CLIENT = boto3.client('secretsmanager', config=_BOTO_CONFIG)
+_S3_CLIENT = boto3.client('s3', config=_BOTO_CONFIG)
+
+def _is_password(value):
+    """Check a stripped message for 20+ ASCII alphanumerics, same as ^[A-Za-z0-9]{20,}$"""
+    return len(value) >= 20 and value.isascii() and value.isalnum()
+
+def _looks_like_signing_line(message):
+    """Cheap pre-check that rejects most non signing key lines before the regex runs"""
+    return len(message) >= 9 and message[4].isspace() and message[0] in _HEX_DIGITS
+
+def _chunk_events(events, max_bytes=MAX_BATCH_BYTES, max_count=MAX_BATCH_EVENTS):
+    """Split timestamp ordered events into batches that fit a single PutLogEvents call"""
+    batch = []
+    batch_bytes = 0
+    
+    for event in events:
+        event_bytes = len(event['message'].encode('utf-8')) + EVENT_OVERHEAD_BYTES
+        if batch and (
+            batch_bytes + event_bytes > max_bytes
+            or len(batch) >= max_count
+            or event['timestamp'] - batch[0]['timestamp'] >= MAX_BATCH_SPAN_MS
+        ):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        
+        batch.append(event)
+        batch_bytes += event_bytes
+    
+    if batch:
+        yield batch
+
+def get_candidate_streams(logs_client, log_group_name):
+    """Get (stream name, has password lines) for matching streams, most recent first"""
+    last_event_times = {}
+    password_streams = set()
+    paginator = logs_client.get_paginator('filter_log_events')
+    end_time = int(time.time() * 1000)
+    pages = paginator.paginate(
+        logGroupName=log_group_name,
+        filterPattern=STREAM_FILTER_PATTERN,
+        startTime=end_time - SEARCH_WINDOW_MS,
+        endTime=end_time
+    )
+    
+    for page in pages:
+        for event in page['events']:
+            stream_name = event['logStreamName']
+            last_event_times[stream_name] = max(event['timestamp'], last_event_times.get(stream_name, 0))
+            if _is_password(event['message'].strip()):
+                password_streams.add(stream_name)
+    
+    return [
+        (stream_name, stream_name in password_streams)
+        for stream_name in sorted(last_event_times, key=last_event_times.get, reverse=True)
+    ]
 
 def get_log_events(logs_client, log_group_name, stream_name):
-    """Get all log events from a stream with pagination"""
-    log_events = []
+    """Get all log events from a stream with pagination, as parallel timestamp and message lists"""
+    timestamps = []
+    messages = []
     next_token = None
     
     while True:
@@ -29,35 +117,52 @@ def get_log_events(logs_client, log_group_name, stream_name):
             params['nextToken'] = next_token
         
         events = logs_client.get_log_events(**params)
-        log_events.extend(events['events'])
+        for event in events['events']:
+            timestamps.append(event['timestamp'])
+            messages.append(event['message'])
         
         next_forward_token = events.get('nextForwardToken')
         if next_forward_token == next_token:
             break
         next_token = next_forward_token
     
-    return log_events
-
-def find_password(log_events):
-    """Find password in log events"""
-    for i, event in enumerate(log_events):
-        if PASSWORD_MARKER in event['message']:
-            for j in range(i + 1, len(log_events)):
-                next_message = log_events[j]['message'].strip()
-                if re.match(PASSWORD_REGEX, next_message):
-                    return next_message
-    return None
+    return timestamps, messages
 
-def extract_public_key(log_events):
-    """Extract public key from log events"""
-    public_key = ""
-    for event in log_events:
-        if re.match(SIGNING_KEY_REGEX, event['message']):
-            public_key += event['message'].strip() + '\n'
-    return public_key
+def scan_stream(messages):
+    """Scan messages once for the password, public key and lines to redact, stopping at a redacted line"""
+    password = None
+    saw_password_marker = False
+    public_key_lines = []
+    redacted_indices = []
+    
+    # Bind hot lookups to locals for the per-event loop
+    looks_like_signing_line = _looks_like_signing_line
+    is_signing_key = _SIGNING_KEY_RE.match
+    is_password = _is_password
+    add_key_line = public_key_lines.append
+    add_redaction = redacted_indices.append
+    
+    for index, message in enumerate(messages):
+        stripped = message.strip()
+        
+        # Redaction writes REDACTED_TEXT as the whole message, so only short lines can carry it
+        if len(message) < 32 and REDACTED_TEXT in message:
+            return True, None, [], []
+        
+        if looks_like_signing_line(message) and is_signing_key(message):
+            add_key_line(stripped)
+        
+        if is_password(stripped):
+            if saw_password_marker and password is None:
+                password = stripped
+            add_redaction(index)
+        elif PASSWORD_MARKER in message:
+            saw_password_marker = True
+    
+    return False, password, public_key_lines, redacted_indices
 
 def update_secret_password(secrets_client, secret_arn, password):
-    """Update password in secrets manager while preserving other data"""
+    """Update password in secrets manager while preserving other data, returns False if unchanged"""
     try:
         existing_secret = secrets_client.get_secret_value(SecretId=secret_arn)
         secret_data = json.loads(existing_secret['SecretString'])
@@ -66,31 +171,41 @@ def update_secret_password(secrets_client, secret_arn, password):
         logger.warning(f"Could not read existing secret: {e}")
         secret_data = {}
     
+    if secret_data.get('password') == password:
+        return False
+    
     secret_data['password'] = password
     logger.info(f"Updated secret keys: {list(secret_data.keys())}")
     
     secrets_client.update_secret(
         SecretId=secret_arn,
-        SecretString=json.dumps(secret_data)
+        SecretString=json.dumps(secret_data, separators=(',', ':'))
     )
+    return True
 
-def redact_log_stream(logs_client, log_group_name, stream_name, log_events):
-    """Redact password from log stream"""
-    redacted_events = []
-    redacted_count = 0
-    
-    for event in log_events:
-        message = event['message']
-        if re.match(PASSWORD_REGEX, message.strip()):
-            message = REDACTED_TEXT
-            redacted_count += 1
-        
-        redacted_events.append({
-            'timestamp': event['timestamp'],
-            'message': message
-        })
+def _count_unwritable_events(timestamps, retention_days):
+    """Count events PutLogEvents would reject if the stream were rewritten now"""
+    now = int(time.time() * 1000)
+    oldest = now - min(MAX_EVENT_AGE_MS, retention_days * 24 * 60 * 60 * 1000) + REWRITE_MARGIN_MS
+    newest = now + MAX_EVENT_LEAD_MS - REWRITE_MARGIN_MS
+    return sum(1 for timestamp in timestamps if timestamp < oldest or timestamp > newest)
+
+def redact_log_stream(logs_client, log_group_name, stream_name, timestamps, messages, redacted_indices, retention_days):
+    """Replace log stream with its events, redacting messages at the given indices"""
+    # Deleting the stream is irreversible, so refuse when any event could not be written back
+    unwritable_count = _count_unwritable_events(timestamps, retention_days)
+    if unwritable_count:
+        raise RuntimeError(
+            f"{unwritable_count} events are outside the PutLogEvents time window, stream left unredacted"
+        )
+    
+    for index in redacted_indices:
+        messages[index] = REDACTED_TEXT
+    log_events = sorted(
+        ({'timestamp': timestamp, 'message': message} for timestamp, message in zip(timestamps, messages)),
+        key=lambda event: event['timestamp']
+    )
     
-    # Replace log stream
     logs_client.delete_log_stream(
         logGroupName=log_group_name,
         logStreamName=stream_name
@@ -100,14 +215,19 @@ def redact_log_stream(logs_client, log_group_name, stream_name, log_events):
         logStreamName=stream_name
     )
     
-    if redacted_events:
-        logs_client.put_log_events(
+    # CloudWatch accepts batches but silently drops too old, too new or expired events
+    rejected_batches = []
+    for batch in _chunk_events(log_events):
+        response = logs_client.put_log_events(
             logGroupName=log_group_name,
             logStreamName=stream_name,
-            logEvents=redacted_events
+            logEvents=batch
         )
+        if response.get('rejectedLogEventsInfo'):
+            rejected_batches.append(response['rejectedLogEventsInfo'])
     
-    return redacted_count
+    if rejected_batches:
+        raise RuntimeError(f"CloudWatch rejected events while rewriting stream: {rejected_batches}")
 
 def upload_public_key(s3_client, bucket_name, kms_key_id, public_key):
     """Upload public key to S3"""
@@ -128,83 +248,98 @@ def lambda_handler(event, context):
         secret_arn = os.environ['SECRET_ARN']
         bucket_name = os.environ['BUCKET_NAME']
         kms_key_id = os.environ['KMS_KEY_ID']
-        region = os.environ['AWS_REGION']
+        retention_days = int(os.environ['LOG_RETENTION_DAYS'])
         
         logger.info(f"Processing log group: {log_group_name}")
         
-        # Initialize AWS clients
-        boto_config = Config(
-            retries={"max_attempts": 10, "mode": "adaptive"},
-            use_fips_endpoint=True if region.startswith(('us', 'ca')) else None
-        )
-        logs_client = boto3.client('logs', config=boto_config)
-        secrets_client = boto3.client('secretsmanager', config=boto_config)
-        s3_client = boto3.client('s3', config=boto_config)
-        
-        # Get all log streams with pagination
-        all_streams = []
-        next_token = None
-        
-        while True:
-            params = {
-                'logGroupName': log_group_name,
-                'orderBy': 'LastEventTime',
-                'descending': True
-            }
-            if next_token:
-                params['nextToken'] = next_token
-            
-            streams = logs_client.describe_log_streams(**params)
-            all_streams.extend(streams['logStreams'])
-            
-            next_token = streams.get('nextToken')
-            if not next_token:
-                break
-        
-        logger.info(f"Found {len(all_streams)} log streams")
+        # Only streams matching the filter can hold a password or public key
+        candidate_streams = get_candidate_streams(_LOGS_CLIENT, log_group_name)
+        logger.info(f"Found {len(candidate_streams)} candidate log streams")
         
         password_found = False
-        public_key = ""
+        public_key_parts = []
+        pending_redactions = []
         
-        for stream_idx, stream in enumerate(all_streams):
-            stream_name = stream['logStreamName']
-            logger.info(f"Processing stream {stream_idx + 1}: {stream_name}")
-            
-            log_events = get_log_events(logs_client, log_group_name, stream_name)
-            logger.debug(f"Found {len(log_events)} log events")
-            
-            # Skip if already redacted
-            if any(REDACTED_TEXT in event['message'] for event in log_events):
-                logger.info("Stream already processed, skipping")
-                continue
+        def fetch_stream(stream_name):
+            return get_log_events(_LOGS_CLIENT, log_group_name, stream_name)
+        
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # Fetch candidate streams concurrently, processed in stream order
+            fetches = [executor.submit(fetch_stream, stream_name) for stream_name, _ in candidate_streams]
+            processed_count = 0
             
-            # Find password
-            if not password_found:
-                password = find_password(log_events)
-                if password:
-                    logger.info(f"Found a password")
-                    update_secret_password(secrets_client, secret_arn, password)
-                    logger.info("Password updated in Secrets Manager")
-                    password_found = True
+            for stream_idx, (stream_name, _) in enumerate(candidate_streams):
+                processed_count += 1
+                logger.info(f"Processing stream {stream_idx + 1}: {stream_name}")
+                timestamps, messages = fetches[stream_idx].result()
+                # Only streams queued for redaction should stay in memory
+                fetches[stream_idx] = None
+                logger.debug(f"Found {len(messages)} log events")
+                
+                redacted_seen, password, public_key_lines, redacted_indices = scan_stream(messages)
+                
+                # Skip if already redacted
+                if redacted_seen:
+                    logger.info("Stream already processed, skipping")
+                    continue
+                
+                # Find password
+                if not password_found:
+                    if password:
+                        logger.info(f"Found a password")
+                        if update_secret_password(_SECRETS_CLIENT, secret_arn, password):
+                            logger.info("Password updated in Secrets Manager")
+                        else:
+                            logger.info("Password already stored in Secrets Manager")
+                        password_found = True
+                
+                # Extract public key
+                public_key_parts.extend(public_key_lines)
+                
+                # Streams without password lines are left in place
+                if redacted_indices:
+                    pending_redactions.append((stream_name, timestamps, messages, redacted_indices))
+                
+                if password_found and len(public_key_parts) >= EXPECTED_KEY_LINES:
+                    logger.info("Password and public key found, skipping remaining streams")
+                    break
             
-            # Extract public key
-            stream_public_key = extract_public_key(log_events)
-            if stream_public_key:
-                public_key += stream_public_key
+            # Streams left after an early exit only need reading if they hold password lines
+            for stream_idx in range(processed_count, len(candidate_streams)):
+                stream_name, has_password_lines = candidate_streams[stream_idx]
+                fetch = fetches[stream_idx]
+                fetches[stream_idx] = None
+                if not has_password_lines:
+                    fetch.cancel()
+                    continue
+                timestamps, messages = fetch.result()
+                redacted_seen, _, _, redacted_indices = scan_stream(messages)
+                if not redacted_seen and redacted_indices:
+                    pending_redactions.append((stream_name, timestamps, messages, redacted_indices))
             
-            # Redact logs if password was found
+            # Redact logs concurrently if password was found
             if password_found:
-                try:
-                    redacted_count = redact_log_stream(logs_client, log_group_name, stream_name, log_events)
-                    logger.info(f"Redacted {redacted_count} password lines")
-                except Exception as e:
-                    logger.error(f"Failed to redact stream {stream_name}: {e}")
+                futures = {
+                    executor.submit(
+                        redact_log_stream, _LOGS_CLIENT, log_group_name, stream_name, timestamps, messages,
+                        redacted_indices, retention_days
+                    ): (stream_name, len(redacted_indices))
+                    for stream_name, timestamps, messages, redacted_indices in pending_redactions
+                }
+                for future in as_completed(futures):
+                    stream_name, redacted_count = futures[future]
+                    try:
+                        future.result()
+                        logger.info(f"Redacted {redacted_count} password lines in {stream_name}")
+                    except Exception as e:
+                        logger.error(f"Failed to redact stream {stream_name}: {e}")
         
         # Upload public key to S3
+        public_key = '\n'.join(public_key_parts) + '\n' if public_key_parts else ""
         if public_key:
             try:
-                upload_public_key(s3_client, bucket_name, kms_key_id, public_key)
-                logger.info(f"Public key uploaded ({len(public_key.splitlines())} lines)")
+                upload_public_key(_S3_CLIENT, bucket_name, kms_key_id, public_key)
+                logger.info(f"Public key uploaded ({len(public_key_parts)} lines)")
             except Exception as e:
                 logger.error(f"Failed to upload public key: {e}")
         else:
@@ -8,37 +8,103 @@ Decrypts messages stored by the Wickr Data Retention Bot from AWS S3.
 import argparse
 import base64
 import json
+import os
+import stat
 import sys
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import boto3
 from botocore.config import Config
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
+CHUNK_SIZE = 1 << 20
+MAX_WORKERS = 16
+
+
+class DecryptError(Exception):
+    """Raised when a message cannot be decrypted."""
 
-def decrypt_message(bucket, key, region, output_file):
-    """Decrypt a Wickr message from S3."""
+
+def create_clients(region):
+    """Create S3 and KMS clients shared by every decrypt in a run."""
 
     boto_config = Config(
         region_name=region,
-        use_fips_endpoint=True if region.startswith(('us', 'ca')) else None
+        use_fips_endpoint=True if region.startswith(('us', 'ca')) else None,
+        max_pool_connections=MAX_WORKERS
     )
 
-    s3 = boto3.client("s3", config=boto_config)
-    kms = boto3.client("kms", config=boto_config)
-    
+    return boto3.client("s3", config=boto_config), boto3.client("kms", config=boto_config)
+
+
+def cached_data_key_decrypter(kms):
+    """Return a KMS data key decrypt that makes one call per (encrypted key, encryption context)."""
+
+    lock = threading.Lock()
+    data_keys = {}
+
+    def decrypt_data_key(edk, matdesc_json):
+        cache_key = (edk, matdesc_json)
+        with lock:
+            future = data_keys.get(cache_key)
+            is_owner = future is None
+            if is_owner:
+                future = data_keys[cache_key] = Future()
+
+        # The first caller for a data key calls KMS, concurrent callers wait on its result
+        if is_owner:
+            try:
+                future.set_result(kms.decrypt(
+                    CiphertextBlob=edk,
+                    EncryptionContext=json.loads(matdesc_json)
+                )["Plaintext"])
+            except BaseException as e:
+                # Failures are not cached so a later call can retry
+                with lock:
+                    del data_keys[cache_key]
+                future.set_exception(e)
+
+        return future.result()
+
+    return decrypt_data_key
+
+
+def write_all(fd, data):
+    """Write all of data to a raw file descriptor."""
+
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def decrypt_message(s3, decrypt_data_key, bucket, key, output_file):
+    """Decrypt a Wickr message from S3."""
+
     # Fetch object + metadata
     try:
         obj = s3.get_object(Bucket=bucket, Key=key)
-        body = obj["Body"].read()
         meta = obj.get("Metadata", {})
     except Exception as e:
-        sys.exit(f"Error fetching S3 object: {e}")
+        raise DecryptError(f"Error fetching S3 object: {e}")
     
+    # Release the pooled connection even when the body is not read to the end
+    try:
+        decrypt_object(obj, meta, decrypt_data_key, output_file)
+    finally:
+        obj["Body"].close()
+
+
+def decrypt_object(obj, meta, decrypt_data_key, output_file):
+    """Decrypt a fetched S3 object into output_file."""
+
     def get_metadata(k):
         v = meta.get(k)
         if v is None:
-            sys.exit(f"Missing required metadata: {k}")
+            raise DecryptError(f"Missing required metadata: {k}")
         return v
     
     # Extract encryption metadata
@@ -52,39 +118,92 @@ def decrypt_message(bucket, key, region, output_file):
     edk = base64.b64decode(key_v2_b64)
     
     if tag_len_bits % 8 != 0:
-        sys.exit("x-amz-tag-len not multiple of 8")
+        raise DecryptError("x-amz-tag-len not multiple of 8")
     tag_len = tag_len_bits // 8
     
     # Decrypt data key with KMS
     try:
-        encryption_context = json.loads(matdesc_json)
-        dek_plain = kms.decrypt(
-            CiphertextBlob=edk,
-            EncryptionContext=encryption_context
-        )["Plaintext"]
+        dek_plain = decrypt_data_key(edk, matdesc_json)
     except Exception as e:
-        sys.exit(f"Error decrypting data key: {e}")
+        raise DecryptError(f"Error decrypting data key: {e}")
     
-    # Split ciphertext and GCM tag
-    if len(body) < tag_len:
-        sys.exit("Object too small to contain a GCM tag")
-    ciphertext = body[:-tag_len]
-    tag = body[-tag_len:]
+    if obj["ContentLength"] < tag_len:
+        raise DecryptError("Object too small to contain a GCM tag")
     
-    # AES-GCM decrypt
+    # Regular files are written to a temp file and only replace the target once authenticated,
+    # devices, pipes and FIFOs can't be replaced so they are written directly
+    output_path = Path(os.path.realpath(output_file))
+    temp_path = None
     try:
-        aesgcm = AESGCM(dek_plain)
-        plaintext = aesgcm.decrypt(iv, ciphertext + tag, None)
-    except Exception as e:
-        sys.exit(f"Error decrypting message: {e}")
+        if output_path.exists() and not output_path.is_file():
+            fd = os.open(output_path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        else:
+            fd, temp_path = tempfile.mkstemp(dir=output_path.parent, prefix=f".{output_path.name}.", suffix=".tmp")
+    except OSError as e:
+        raise DecryptError(f"Error writing output file: {e}")
     
-    # Write result
+    # AES-GCM decrypt, streaming ciphertext and holding back the trailing tag
     try:
-        with open(output_file, "wb") as f:
-            f.write(plaintext)
-        print(f"Decrypted → {output_file}")
+        try:
+            # Reserve the plaintext size up front where the platform and file allow it
+            plaintext_len = obj["ContentLength"] - tag_len
+            if plaintext_len and hasattr(os, "posix_fallocate") and stat.S_ISREG(os.fstat(fd).st_mode):
+                try:
+                    os.posix_fallocate(fd, 0, plaintext_len)
+                except OSError:
+                    pass
+            
+            decryptor = Cipher(algorithms.AES(dek_plain), modes.GCM(iv)).decryptor()
+            # Only the trailing tag_len bytes are carried between chunks, the rest of each
+            # chunk is decrypted through a memoryview without being copied
+            tail = b""
+            for chunk in obj["Body"].iter_chunks(chunk_size=CHUNK_SIZE):
+                if len(chunk) < tag_len:
+                    chunk = tail + chunk
+                    tail = b""
+                if tail:
+                    write_all(fd, decryptor.update(tail))
+                if len(chunk) > tag_len:
+                    write_all(fd, decryptor.update(memoryview(chunk)[:-tag_len]))
+                tail = chunk[-tag_len:]
+            write_all(fd, decryptor.finalize_with_tag(tail))
+        finally:
+            os.close(fd)
+        if temp_path:
+            os.replace(temp_path, output_path)
+            temp_path = None
     except Exception as e:
-        sys.exit(f"Error writing output file: {e}")
+        raise DecryptError(f"Error decrypting message: {'authentication tag mismatch' if isinstance(e, InvalidTag) else e}")
+    finally:
+        # Never leave unauthenticated plaintext behind, including on interrupt
+        if temp_path:
+            Path(temp_path).unlink(missing_ok=True)
+    print(f"Decrypted → {output_file}")
+
+
+def decrypt_batch(s3, decrypt_data_key, bucket, keys, output_dir):
+    """Decrypt many Wickr messages concurrently into output_dir, returning the failure count."""
+
+    output_root = output_dir.resolve()
+    failures = 0
+
+    def decrypt_to_dir(key):
+        output_file = (output_root / key).resolve()
+        if output_root not in output_file.parents:
+            raise DecryptError(f"Key would be written outside the output directory: {key}")
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        decrypt_message(s3, decrypt_data_key, bucket, key, output_file)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(decrypt_to_dir, key): key for key in keys}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failures += 1
+                print(f"{futures[future]}: {e}", file=sys.stderr)
+
+    return failures
 
 
 def main():
@@ -93,27 +212,52 @@ def main():
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog="""Examples:
   %(prog)s -b my-bucket -k data/message.txt -o decrypted.txt
-  %(prog)s -b my-bucket -k data/attachment.pdf -r us-west-2 -o file.pdf"""
+  %(prog)s -b my-bucket -k data/attachment.pdf -r us-west-2 -o file.pdf
+  %(prog)s -b my-bucket --keys-file keys.txt -o decrypted/"""
     )
     
     parser.add_argument("-b", "--bucket", required=True,
                        help="S3 bucket name containing encrypted message")
-    parser.add_argument("-k", "--key", required=True,
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-k", "--key",
                        help="S3 object key (path) to encrypted message")
+    source.add_argument("--keys-file",
+                       help="File of newline-delimited S3 object keys to decrypt in one run")
     parser.add_argument("-r", "--region", default="us-east-1",
                        help="AWS region (default: us-east-1)")
     parser.add_argument("-o", "--output", required=True,
-                       help="Output file path for decrypted message")
+                       help="Output file path for decrypted message, or output directory with --keys-file")
     
     args = parser.parse_args()
+    output_path = Path(args.output)
+    
+    if args.keys_file:
+        # Validate output directory exists
+        if not output_path.is_dir():
+            sys.exit(f"Output directory does not exist: {output_path}")
+        try:
+            lines = Path(args.keys_file).read_text().splitlines()
+        except OSError as e:
+            sys.exit(f"Error reading keys file: {e}")
+        # Duplicate keys would race on the same output file
+        keys = list(dict.fromkeys(line.strip() for line in lines if line.strip()))
+        
+        s3, kms = create_clients(args.region)
+        failures = decrypt_batch(s3, cached_data_key_decrypter(kms), args.bucket, keys, output_path)
+        if failures:
+            sys.exit(f"{failures} of {len(keys)} messages failed to decrypt")
+        return
     
     # Validate output directory exists
-    output_path = Path(args.output)
     if not output_path.parent.exists():
         sys.exit(f"Output directory does not exist: {output_path.parent}")
     
-    decrypt_message(args.bucket, args.key, args.region, args.output)
+    s3, kms = create_clients(args.region)
+    try:
+        decrypt_message(s3, cached_data_key_decrypter(kms), args.bucket, args.key, args.output)
+    except DecryptError as e:
+        sys.exit(str(e))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()